@@ -7,7 +7,7 @@
 # python ld-trace.py -y func --whole-archive --gc-sections mymain.o libfoo.a
 
 # Limitations:
-# - Linux only, relies on objdump and nm.
+# - Linux only, relies on objdump (and nm with --prefilter).
 # - Tested on object (.o) and archive (.a) files only.
 # - Object files are currently treated the same as archive files.
 #   Without --whole-archive, object files should still always be included.
@@ -16,14 +16,35 @@
 #   -T/--script: Linker scripts are not supported.
 #   --start-group/--end-group: Symbols are always globally resolved, like in lld.
 
-from typing import FrozenSet, Union, NamedTuple, DefaultDict, List, Dict, Set, AbstractSet, Tuple, Callable
-from collections import defaultdict
+from typing import FrozenSet, Union, NamedTuple, DefaultDict, List, Dict, Set, AbstractSet, Tuple, Callable, Iterator, Optional, TypeVar
+from collections import defaultdict, deque
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor
 import argparse
+import io
+import mmap
 import subprocess
 import os
+import re
 import sys
-from hashlib import sha256
-from itertools import groupby
+import tempfile
+import time
+from hashlib import blake2b
+
+# The cache key is only used as a file name, no need for a cryptographic hash.
+# xxhash is optional and used if installed.
+try:
+    from xxhash import xxh3_128_hexdigest as fast_hash
+except ImportError:
+    def fast_hash(data: bytes) -> str:
+        return blake2b(data, digest_size=16).hexdigest()
+
+# Used for hashing archive contents, blake3 is optional and used if installed.
+try:
+    from blake3 import blake3 as file_hasher
+except ImportError:
+    def file_hasher():
+        return blake2b(digest_size=16)
 
 # Archive
 #  Object
@@ -38,18 +59,77 @@ class Section(NamedTuple):
     name: str
     obj: Object
 
-class DefinedSymbol(NamedTuple):
+# Objects and sections are used as dict/set keys throughout. Share a single instance
+# per distinct value instead of creating a new one for every parsed line.
+
+@lru_cache(maxsize=None)
+def mk_object(name: str, archive: str) -> Object:
+    return Object(sys.intern(name), archive)
+
+@lru_cache(maxsize=None)
+def mk_section(name: str, obj: Object) -> Section:
+    return Section(sys.intern(name), obj)
+
+# Symbols and references are by far the most numerous instances, use __slots__
+# classes instead of NamedTuples and compute hashes once.
+
+class DefinedSymbol:
+    __slots__ = ('name', 'type', 'is_global', 'src', 'section', '_hash')
+
     name: str
     type: str
     is_global: bool
     src: str
     section: Section
 
-class SymbolReference(NamedTuple):
+    def __init__(self, name: str, type: str, is_global: bool, src: str, section: Section):
+        self.name = name
+        self.type = type
+        self.is_global = is_global
+        self.src = src
+        self.section = section
+        # A symbol name is unique within a section.
+        self._hash = hash((name, section))
+
+    def __eq__(self, other):
+        if not isinstance(other, DefinedSymbol):
+            return NotImplemented
+        return self is other or (self.name == other.name and self.section == other.section)
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return (f'DefinedSymbol(name={self.name!r}, type={self.type!r}, is_global={self.is_global!r}, '
+                f'src={self.src!r}, section={self.section!r})')
+
+class SymbolReference:
+    __slots__ = ('referencing_sym', 'referenced_sym', 'src', '_hash')
+
     referencing_sym: DefinedSymbol
     referenced_sym: str
     src: str
 
+    def __init__(self, referencing_sym: DefinedSymbol, referenced_sym: str, src: str):
+        self.referencing_sym = referencing_sym
+        self.referenced_sym = referenced_sym
+        self.src = src
+        self._hash = hash((referencing_sym, referenced_sym, src))
+
+    def __eq__(self, other):
+        if not isinstance(other, SymbolReference):
+            return NotImplemented
+        return self is other or (self.referencing_sym == other.referencing_sym and
+                                 self.referenced_sym == other.referenced_sym and
+                                 self.src == other.src)
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return (f'SymbolReference(referencing_sym={self.referencing_sym!r}, '
+                f'referenced_sym={self.referenced_sym!r}, src={self.src!r})')
+
 # TODO treat .o files differently than .a files
 
 parser = argparse.ArgumentParser()
@@ -78,9 +158,24 @@ parser.add_argument('--first-only', action='store_true', help='show only the fir
 parser.add_argument('--cache-dir', default=os.path.expanduser('~/.cache/ld-trace'), help='cache directory')
 parser.add_argument('--refresh-cache', action='store_true')
 parser.add_argument('--no-cache', action='store_true')
+parser.add_argument('--prefilter', action='store_true',
+                    help='skip files that cannot be part of a trace, based on a quick nm pass')
 
 args, remaining = parser.parse_known_args()
 
+# Verbose/trace output can be millions of lines. Write it in large blocks instead of
+# flushing every line on terminals, progress lines and found paths are flushed explicitly.
+# Plain output on a terminal stays line buffered, so results show up as they are found.
+if args.verbose or args.trace or not sys.stdout.isatty():
+    sys.stdout = io.TextIOWrapper(open(sys.stdout.fileno(), 'wb', buffering=1 << 20, closefd=False),
+                                  encoding=sys.stdout.encoding, errors=sys.stdout.errors)
+
+    # Write out pending warnings before a traceback, not after it.
+    def flush_stdout_excepthook(*exc_info, excepthook=sys.excepthook):
+        sys.stdout.flush()
+        excepthook(*exc_info)
+    sys.excepthook = flush_stdout_excepthook
+
 def exit_if_fatal_warnings():
     if args.fatal_warnings:
         print('Stopping as --fatal-warnings was given')
@@ -110,64 +205,225 @@ else:
         print('--whole-archive/--require-defined/--entry not given, defaulting to --entry _start')
         args.require_defined = ['_start']
 
-if not args.no_cache:
+if args.no_cache:
+    tmp_dir = tempfile.TemporaryDirectory(prefix='ld-trace-')
+    cache_dir = tmp_dir.name
+else:
     os.makedirs(args.cache_dir, exist_ok=True)
-
-def run(args_: List[str], depends: List[str]) -> str:
+    cache_dir = args.cache_dir
+
+RACY_MTIME_NS = 2_000_000_000
+
+# Inputs are stat'ed once per run, even if several tools (objdump, nm for --prefilter) read them.
+@lru_cache(maxsize=None)
+def stat_input(path: str) -> os.stat_result:
+    return os.stat(path)
+
+# Temporary files are created private (0600), cache files get the usual permissions so caches can be shared.
+# The umask can only be read by setting it, done once before any worker threads exist.
+umask = os.umask(0)
+os.umask(umask)
+CACHE_FILE_MODE = 0o666 & ~umask
+
+def write_atomic(path: str, text: str, cache_dir: str):
+    # Other workers may read cache files concurrently, replace them atomically.
+    with tempfile.NamedTemporaryFile('w', dir=cache_dir, delete=False) as f:
+        f.write(text)
+        os.fchmod(f.fileno(), CACHE_FILE_MODE)
+    os.replace(f.name, path)
+
+def content_hash(path: str, cache_dir: str, refresh_cache: bool) -> str:
+    # Rebuilds often touch archives without changing them, so cached outputs are keyed on content.
+    # The hash is kept in a sidecar file and reused as long as mtime and size are unchanged.
+    st = stat_input(path)
+    stamp = f'{st.st_mtime_ns} {st.st_size}'
+    meta_path = os.path.join(cache_dir, fast_hash(os.path.abspath(path).encode()) + '.meta')
+    if not refresh_cache:
+        try:
+            with open(meta_path) as f:
+                meta_stamp, hash_ = f.read().rsplit(' ', 1)
+            if meta_stamp == stamp:
+                return hash_
+        except (OSError, ValueError):
+            pass
+    hasher = file_hasher()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            hasher.update(chunk)
+    hash_ = hasher.hexdigest()
+    # A file modified again right after hashing may keep the same mtime (coarse timestamps),
+    # the stamp would then match stale content. Only remember hashes of files that are old enough.
+    if time.time_ns() - st.st_mtime_ns < RACY_MTIME_NS:
+        return hash_
+    write_atomic(meta_path, f'{stamp} {hash_}', cache_dir)
+    return hash_
+
+def run(args_: List[str], depends: List[str], no_cache: bool, cache_dir: str, refresh_cache: bool) -> Tuple[str, str]:
+    # Returns the path of a file holding the cache key line and stdout (streamed by read_lines()/iter_objdump_lines())
+    # and a status line for --verbose. Runs happen in worker threads and finish in any order,
+    # tool_output() prints the status from the main thread in the order of args.files.
+    # With --no-cache, cache_dir is a temporary directory and files are never reused.
     assert len(depends) > 0
     cmd = ' '.join(args_)
-    if args.verbose:
-        print(f'> {cmd}', end='', flush=True)
-    out = None
-    cache_path = None
-    mtime = None
-    if not args.no_cache:
-        mtime = max(os.path.getmtime(path) for path in depends)
-        sha = sha256(cmd.encode()).hexdigest()
-        cache_path = os.path.join(args.cache_dir, sha)
-        if not args.refresh_cache and os.path.exists(cache_path) and os.path.getmtime(cache_path) == mtime:
-            with open(cache_path) as f:
-                out = f.read()
-    if out is None:       
-        out = subprocess.run(args_, capture_output=True, check=True, universal_newlines=True).stdout
-        if not args.no_cache:
-            assert cache_path
-            assert mtime
-            with open(cache_path, 'w') as f:
-                f.write(out)
-            os.utime(cache_path, (mtime, mtime))
-            
-        if args.verbose:
-            print(' ✔️')
+    # One entry per command, its first line holds the content hashes of the inputs.
+    # Rebuilt inputs overwrite the entry instead of piling up outputs.
+    # Key and output are replaced together, a key never vouches for another run's output.
+    out_path = os.path.join(cache_dir, fast_hash(cmd.encode()))
+    key = ''
+    cached = False
+    if not no_cache:
+        key = ' '.join(content_hash(path, cache_dir, refresh_cache) for path in depends)
+        if not refresh_cache:
+            try:
+                with open(out_path) as f:
+                    cached = f.readline() == key + '\n'
+            except OSError:
+                pass
+    if not cached:
+        # The child writes straight to the file, output is never held in memory as a whole.
+        # Output goes to a temporary file that replaces the cache entry once complete,
+        # concurrent runs sharing the cache never see partial output.
+        f = tempfile.NamedTemporaryFile('w', dir=cache_dir, delete=False)
+        try:
+            with f:
+                f.write(key + '\n')
+                f.flush() # the child appends to the same file offset
+                subprocess.run(args_, stdout=f, stderr=subprocess.PIPE, check=True)
+                os.fchmod(f.fileno(), CACHE_FILE_MODE)
+            os.replace(f.name, out_path)
+        except BaseException:
+            # Never leave partial output behind.
+            os.remove(f.name)
+            raise
+        return out_path, f'> {cmd} ✔️'
     else:
-        if args.verbose:
-            print(' ✔️  (cached)')        
-    return out
+        return out_path, f'> {cmd} ✔️  (cached)'
 
-def fmt_path(p):
+def tool_output(future: 'Future[Tuple[str, str]]') -> str:
+    out_path, status = future.result()
+    if args.verbose:
+        print(status, flush=True)
+    return out_path
+
+def read_lines(path: str) -> Iterator[str]:
+    with open(path) as f:
+        f.readline() # cache key
+        for line in f:
+            yield line.rstrip('\n')
+
+# Cache options are passed explicitly to keep the workers independent of global state.
+
+def collect_syms_and_relocs(archive: str, no_cache: bool, cache_dir: str, refresh_cache: bool) -> Tuple[str, str]:
+    # A single objdump run provides symbols with their sections and relocations with source lines,
+    # each archive is opened and parsed only once.
+    return run(['objdump', '--syms', '--reloc', '--line-numbers', archive], [archive],
+               no_cache, cache_dir, refresh_cache)
+
+def collect_nm_syms(archive: str, no_cache: bool, cache_dir: str, refresh_cache: bool) -> Tuple[str, str]:
+    # Only reads the symbol tables, much cheaper than a full objdump run.
+    # Local symbols are included, a traced symbol may be static.
+    return run(['nm', archive], [archive],
+               no_cache, cache_dir, refresh_cache)
+
+strip_prefix = args.strip_prefix or ''
+
+# Called for every printed symbol, the same few paths come up over and over.
+@lru_cache(maxsize=None)
+def fmt_path(p: str) -> str:
     if p.endswith('.a'):
-        return os.path.basename(p)
-    if args.strip_prefix:
-        p = p.replace(args.strip_prefix, '')
+        return p[p.rfind('/') + 1:]
+    if strip_prefix and p.startswith(strip_prefix):
+        return p[len(strip_prefix):]
     return p
 
 SymbolName = str
+T = TypeVar('T')
+
+# 0000000000000000 g     F .text  0000000000000010 a1
+# (variable address size, 7 flag characters)
+# Section symbols (l d, one per function with -ffunction-sections) and undefined symbols
+# are skipped by the regex already, file symbols (l df) are kept for source locations.
+SYM_TABLE_LINE_RE = re.compile(rb'^[0-9a-f]+ (.{5}(?:[^d].|df)) (?!\*UND\*)(\S+)[ \t].*?(\S+)$', re.MULTILINE)
+
+# a.o:     file format elf64-x86-64
+#
+# SYMBOL TABLE:
+# 0000000000000000 l    df *ABS*  0000000000000000 a.c
+# 0000000000000000 g     F .text  0000000000000010 a1
+#
+# RELOCATION RECORDS FOR [.text.a2]:
+# OFFSET           TYPE              VALUE
+# a2():
+# /.../linker-tests/a.c:8 (discriminator 0)
+# 000000000000000a R_X86_64_PLT32    b-0x0000000000000004
+OBJDUMP_LINE_PATTERNS = [
+    rb'(?P<obj>\S+):\s+file format elf64-x86-64',
+    # The whole symbol table up to the next empty line, split by SYM_TABLE_LINE_RE.
+    rb'SYMBOL TABLE:\n(?P<sym_table>(?:.+\n)*)',
+    rb'RELOCATION RECORDS FOR \[(?P<reloc_section>.+)\]:',
+    rb'(?P<func>.+)\(\):',
+    rb'(?P<src>\S+) \(discriminator.*',
+    # .text. is added for local (static) symbols, the addend is required to parse the name.
+    rb'(?P<reloc>\S+ (?P<reloc_type>R_X86_64_(?:PLT32|PC32)\S*)[ \t]+(?:\.text\.)?(?P<ref>\S+?)(?P<addend>-0x[0-9a-f]+)?[ \t]*)',
+]
+# Lines matching none of the patterns are skipped inside the regex engine.
+# With --trace every line is reported, so a catch-all alternative is added.
+OBJDUMP_LINE_RE = re.compile(
+    b'^(?:' + b'|'.join(OBJDUMP_LINE_PATTERNS + ([rb'(?P<other>.+)'] if args.trace else [])) + b')$',
+    re.MULTILINE)
+
+def iter_objdump_lines(path: str) -> Iterator['re.Match[bytes]']:
+    # Scans the whole output with a single finditer() instead of looping over lines in Python.
+    # Files are never empty (and can be mmap'd), they start with the cache key line.
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            yield from OBJDUMP_LINE_RE.finditer(buf, buf.find(b'\n') + 1)
+
+def symbol_type(flags: str, section_name: str) -> str:
+    # Derive the nm symbol type from objdump's symbol flags and section.
+    # Upper case is global, lower case is local.
+    if flags[1] == 'w':
+        return 'V' if flags[6] == 'O' else 'W'
+    # Functions may live in custom sections (section attribute, .init, .fini), like nm treat them as code.
+    if flags[6] == 'F':
+        typ = 't'
+    else:
+        for prefix, typ in (('.text', 't'), ('.data', 'd'), ('.bss', 'b'), ('.rodata', 'r')):
+            if section_name.startswith(prefix):
+                break
+        else:
+            typ = '?'
+    return typ.upper() if flags[0] in 'gu!' else typ
 
 defs: DefaultDict[SymbolName, List[DefinedSymbol]] = defaultdict(list)
 global_defs: DefaultDict[SymbolName, List[DefinedSymbol]] = defaultdict(list)
-defs_grouped: DefaultDict[Object, DefaultDict[Section, Dict[SymbolName, DefinedSymbol]]] = \
-    defaultdict(lambda: defaultdict(dict))
-global_defs_grouped: DefaultDict[Object, DefaultDict[Section, Dict[SymbolName, DefinedSymbol]]] = \
-    defaultdict(lambda: defaultdict(dict))
+# Non-weak global definitions are counted while parsing, conflicts are listed in order of detection.
+strong_def_counts: DefaultDict[SymbolName, int] = defaultdict(int)
+multiply_defined: List[SymbolName] = []
+# Section already refers to its object, sections_by_obj provides the object -> sections direction.
+defs_by_section: Dict[Section, Dict[SymbolName, DefinedSymbol]] = {}
+sections_by_obj: DefaultDict[Object, List[Section]] = defaultdict(list)
 
 refs: DefaultDict[SymbolName, List[SymbolReference]] = defaultdict(list)
 
+# List each search dir once instead of probing it for every library.
+search_dir_files: Dict[str, Set[str]] = {}
+if args.libraries:
+    for search_dir in args.search_dirs:
+        try:
+            search_dir_files[search_dir] = set(os.listdir(search_dir))
+        except OSError:
+            search_dir_files[search_dir] = set()
+
 for namespec in args.libraries:
     found = False
     filename = f'lib{namespec}.a'
     for search_dir in args.search_dirs:
+        if filename not in search_dir_files[search_dir]:
+            continue
         path = os.path.join(search_dir, filename)
-        if os.path.exists(path):
+        # The listing also contains dangling symlinks and directories, skip those like the linker.
+        if os.path.isfile(path):
             args.files.append(path)
             found = True
             break
@@ -176,89 +432,202 @@ for namespec in args.libraries:
         print(args.search_dirs)
         sys.exit(1)
 
-for archive in args.files:
-    # nm does not provide section names, objdump does not provide source/line info, use both.
-    nm_out = run(['nm', '-A', '--defined-only', '--line-numbers', archive], depends=[archive])
-    objdump_out = run(['objdump', '--syms', archive], depends=[archive])
-
-    # parse objdump output to create symbol -> section mapping
-    sym_section_map: DefaultDict[Object, Dict[SymbolName, str]] = defaultdict(dict)
-    obj = None
-    sym_table_found = False
-    for line in objdump_out.splitlines():
-        if args.trace:
-            print(f'LINE: {line}')
-        # a.o:     file format elf64-x86-64
-        #
-        # SYMBOL TABLE:
-        # 0000000000000000 l    df *ABS*  0000000000000000 a.c
-        # 0000000000000000 g     F .text  0000000000000010 a1
-        if line.endswith('file format elf64-x86-64'):
-            obj = Object(line.split()[0][:-1], archive)
-            sym_table_found = False
-        elif line.startswith('SYMBOL TABLE:'):
-            sym_table_found = True
-        elif sym_table_found:
-            assert obj
-            if not line:
-                sym_table_found = False
-                obj = None
-                continue
-            first_space_idx = line.index(' ') # allow variable address size
-            section_name_idx = first_space_idx + 1 + 7 + 1 # skip over flags and whitespace
-            parts = line[section_name_idx:].split()
-            section_name = parts[0]
-            if section_name == '*UND*' or section_name == '*ABS*':
-                continue
-            sym_name = parts[-1]
-            sym_section_map[obj][sym_name] = section_name
-
-    # parse nm output to assemble symbol instances
-    obj = None
-    section = None
-    for line in nm_out.splitlines():
-        if not line:
+# realpath() stats every path component, resolve each file only once.
+@lru_cache(maxsize=None)
+def real_path(path: str) -> str:
+    return os.path.realpath(path)
+
+def submit_per_file(fn: Callable[[str, bool, str, bool], T]) -> List['Future[T]']:
+    # A file may be given more than once, e.g. directly and via -l.
+    # Outputs only depend on the file, so run the tools once and share the result.
+    futures: Dict[str, 'Future[T]'] = {}
+    paths = [real_path(archive) for archive in args.files]
+    for archive, path in zip(args.files, paths):
+        if path not in futures:
+            futures[path] = pool.submit(fn, archive, *cache_opts)
+    return [futures[path] for path in paths]
+
+def read_nm_syms(path: str) -> Tuple[Set[str], Set[str], Set[str]]:
+    # Returns the global defined, undefined and local defined symbols.
+    defined: Set[str] = set()
+    undefined: Set[str] = set()
+    local: Set[str] = set()
+    for line in read_lines(path):
+        # a.o:
+        # 0000000000000010 T a1
+        # 0000000000000000 t a_static
+        #                  U b
+        if not line or line.endswith(':'):
             continue
-        if args.trace:
-            print(f'LINE: {line}')
-        # libqcbor.enclave.a:ieee754.c.o:0000000000000000 T IEEE754_DoubleToSmallestInternal
-        [location, rest] = line.split(maxsplit=1)
-        parts = location.split(':')
-        if len(parts) == 3:
-            [_, object_name, address] = parts
-        elif len(parts) == 2:
-            [object_name, address] = parts
+        # The name is the last column and the type letter directly precedes it.
+        rest, _, sym_name = line.rpartition(' ')
+        typ = rest[-1]
+        if typ in 'Uwv':
+            undefined.add(sym_name)
+        elif typ.isupper() or typ in 'ui':
+            defined.add(sym_name)
         else:
-            assert False, line
-        obj = Object(object_name, archive)
-        parts = rest.split()  
-        typ = parts[0]
-        sym_name = parts[1]
-        src = parts[2] if len(parts) == 4 else '?'
-        is_global = parts[0] in ['T', 'W']
-        if typ not in ['T', 'W', 't']:
-            if args.verbose:
-                print(f'NOTE: ignoring {typ} definition of {sym_name} ({fmt_path(obj.archive)})')
-            continue
-        if typ == 't' and '.text.' in sym_name:
-            if args.verbose:
-                print(f'NOTE: ignoring {typ} definition of {sym_name} ({fmt_path(obj.archive)})')
-            continue
-        section_name = sym_section_map[obj][sym_name]
-        section = Section(section_name, obj)
-        assert section
-        def_symbol = DefinedSymbol(sym_name, typ, is_global, src, section)
-        defs[sym_name].append(def_symbol)
-        defs_grouped[obj][section][sym_name] = def_symbol
-        if is_global:
-            global_defs[sym_name].append(def_symbol)
-            global_defs_grouped[obj][section][sym_name] = def_symbol  
-
-for name, syms in global_defs.items():
-    if sum(sym.type == 'T' for sym in syms) <= 1:
-        continue
+            local.add(sym_name)
+    return defined, undefined, local
+
+# Results are parsed sequentially in submission order, only the subprocesses run concurrently.
+pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+cache_opts = (args.no_cache, cache_dir, args.refresh_cache)
+
+# Stop queued tool runs if anything fails, otherwise exiting waits for all of them.
+try:
+    if args.prefilter:
+        # A file can only be part of a trace if it defines or references a traced symbol, or a global
+        # symbol defined by another such file. Files defining required symbols are kept for the check below.
+        # A traced symbol may also be defined locally, only the global symbols of that file lead on.
+        file_syms = [read_nm_syms(tool_output(future)) for future in submit_per_file(collect_nm_syms)]
+        required = set(args.require_defined or ())
+        traced = set(args.trace_symbol)
+        relevant = [not required.isdisjoint(defined) for defined, _, _ in file_syms]
+        reachable = set(traced)
+        for i, (defined, _, local) in enumerate(file_syms):
+            if not traced.isdisjoint(local):
+                relevant[i] = True
+                reachable |= defined
+        changed = True
+        while changed:
+            changed = False
+            for i, (defined, undefined, _) in enumerate(file_syms):
+                if not relevant[i] and not (reachable.isdisjoint(defined) and reachable.isdisjoint(undefined)):
+                    relevant[i] = True
+                    reachable |= defined
+                    changed = True
+        if args.verbose:
+            for archive, keep in zip(args.files, relevant):
+                if not keep:
+                    print(f'NOTE: skipping {fmt_path(archive)}, no traced symbol reachable')
+        args.files = [archive for archive, keep in zip(args.files, relevant) if keep]
+
+    futures = submit_per_file(collect_syms_and_relocs)
+
+    sym_not_found_warnings_printed = set()
+    for archive, future in zip(args.files, futures):
+        objdump_path = tool_output(future)
+        obj = None
+        section = None
+        sym_name = None
+        src = '?'
+        # Calls to the same function from the same line result in identical references, keep only one.
+        # Referencing symbols are specific to this archive, so the set does not need to outlive it.
+        seen_refs: Set[Tuple[DefinedSymbol, SymbolName, str]] = set()
+        for m in iter_objdump_lines(objdump_path):
+            kind = m.lastgroup
+            if args.trace:
+                if kind == 'sym_table':
+                    print('LINE: SYMBOL TABLE:')
+                    for line in m['sym_table'].decode().splitlines():
+                        print(f'LINE: {line}')
+                else:
+                    print(f'LINE: {m[0].decode()}')
+            if kind == 'obj':
+                obj = mk_object(m['obj'].decode(), archive)
+                section = None
+            elif kind == 'sym_table':
+                assert obj
+                # Source file of the compilation unit, from its file symbol (l df *ABS*).
+                file_src = None
+                for sym_m in SYM_TABLE_LINE_RE.finditer(m['sym_table']):
+                    flags, section_name, sym_name = (g.decode() for g in sym_m.groups())
+                    if flags[5:] == 'df':
+                        file_src = sys.intern(sym_name)
+                        continue
+                    if section_name[0] == '*' or flags[5] == 'd': # *UND*, *ABS*, *COM*, section symbols
+                        continue
+                    sym_name = sys.intern(sym_name)
+                    typ = symbol_type(flags, section_name)
+                    is_global = typ in ['T', 'W']
+                    if typ not in ['T', 'W', 't']:
+                        if args.verbose:
+                            print(f'NOTE: ignoring {typ} definition of {sym_name} ({fmt_path(obj.archive)})')
+                        continue
+                    if typ == 't' and '.text.' in sym_name:
+                        if args.verbose:
+                            print(f'NOTE: ignoring {typ} definition of {sym_name} ({fmt_path(obj.archive)})')
+                        continue
+                    section = mk_section(section_name, obj)
+                    # The symbol table has no line info. Line number records in relocations
+                    # belong to call sites, not definitions, so only the file is known.
+                    def_symbol = DefinedSymbol(sym_name, typ, is_global, file_src or '?', section)
+                    defs[sym_name].append(def_symbol)
+                    section_syms = defs_by_section.get(section)
+                    if section_syms is None:
+                        section_syms = defs_by_section[section] = {}
+                        sections_by_obj[obj].append(section)
+                    section_syms[sym_name] = def_symbol
+                    if is_global:
+                        global_defs[sym_name].append(def_symbol)
+                    if typ == 'T':
+                        strong_def_counts[sym_name] += 1
+                        if strong_def_counts[sym_name] == 2:
+                            multiply_defined.append(sym_name)
+            elif kind == 'reloc_section':
+                sym_name = None
+                src = '?'
+                assert obj
+                section = mk_section(m['reloc_section'].decode(), obj)
+            elif kind == 'func':
+                sym_name = sys.intern(m['func'].decode())
+            elif kind == 'src':
+                src = sys.intern(m['src'].decode())
+            elif kind == 'reloc': # R_X86_64_PLT32/PC32
+                assert obj
+                assert section
+                if sym_name is None:
+                    if args.trace:
+                        print('-> ignoring (sym name missing)')
+                    continue
+                sym = defs_by_section.get(section, {}).get(sym_name)
+                if sym is None:
+                    if sym_name not in sym_not_found_warnings_printed:
+                        sym_not_found_warnings_printed.add(sym_name)
+                        # This may happen with static inline definitions.
+                        print(f'Note: referencing symbol {sym_name} ({section.name}) not found in definitions, ignoring')
+                        if args.trace:
+                            print(f'{obj.name} ({obj.archive})')
+                            for section_ in sections_by_obj[obj]:
+                                print(f' {section_.name}')
+                                for sym_ in defs_by_section[section_].values():
+                                    print(f'   {sym_.name}')
+                    continue
+                ref_sym = m['ref'].decode()
+                # .L., .rodata., ..-
+                starts_with_dot = ref_sym.startswith('.')
+                if m['reloc_type'].startswith(b'R_X86_64_PC32') and starts_with_dot:
+                    if args.trace:
+                        print('-> ignoring (starts with dot and is R_X86_64_PC32)')
+                    continue
+                assert not starts_with_dot
+                if m['addend'] is None:
+                    if args.trace:
+                        print('-> ignoring (cannot parse referenced symbol name)')
+                    continue
+                ref_sym = sys.intern(ref_sym)
+                ref_key = (sym, ref_sym, src)
+                if ref_key in seen_refs:
+                    if args.trace:
+                        print('-> ignoring (duplicate reference)')
+                    continue
+                seen_refs.add(ref_key)
+                refs[ref_sym].append(SymbolReference(
+                    referencing_sym=sym,
+                    referenced_sym=ref_sym,
+                    src=src))
+                if args.trace:
+                    print(f'found reference: {sym_name} -> {ref_sym}')
+            else:
+                if args.trace:
+                    print('-> ignoring')
+finally:
+    pool.shutdown(cancel_futures=True)
+
+for name in multiply_defined:
     print(f'WARNING: multiple global non-weak definitions of {name}:')
-    for sym in syms:
+    for sym in global_defs[name]:
         print(f'  {sym.type} {fmt_path(sym.src)} ({sym.section.obj.name} {fmt_path(sym.section.obj.archive)})')
     exit_if_fatal_warnings()
 
@@ -267,95 +636,21 @@ if args.require_defined:
         if sym_name not in defs:
             raise RuntimeError(f'required symbol {sym_name} not found in global defined symbols')
 
-obj = None
-section = None
-sym_name = None
-src = '?'
-sym_not_found_warnings_printed = set()
-for archive in args.files:
-    objdump_out = run(['objdump', '--reloc', '--line-numbers', archive], depends=[archive])
-    for line in objdump_out.splitlines():
-        if not line:
-            continue
-        if args.trace:
-            print(f'LINE: {line}')
-        # a.o:     file format elf64-x86-64
-        # RELOCATION RECORDS FOR [.text.a2]:
-        # OFFSET           TYPE              VALUE 
-        # a2():
-        # /.../linker-tests/a.c:8 (discriminator 0)
-        # 000000000000000a R_X86_64_PLT32    b-0x0000000000000004
-        if line.endswith('file format elf64-x86-64'):
-            obj = Object(line.split()[0][:-1], archive)
-            section = None
-        elif line.startswith('RELOCATION RECORDS'):
-            sym_name = None
-            src = '?'
-            section_idx = line.index('[')
-            section_name = line[section_idx + 1:-2]
-            assert obj
-            section = Section(section_name, obj)
-        elif line.endswith('():'):
-            sym_name = line[:-3]
-        elif 'discriminator' in line:
-            src = line.split()[0]
-        elif 'R_X86_64_PLT32' in line or 'R_X86_64_PC32' in line:
-            assert obj
-            assert section
-            if sym_name is None:
-                if args.trace:
-                    print('-> ignoring (sym name missing)')
-                continue
-            parts = line.split()
-            ref = parts[2]
-            sym = None
-            if sym_name in defs_grouped[obj][section]:
-                sym = defs_grouped[obj][section][sym_name]
-            else:              
-                if sym_name not in sym_not_found_warnings_printed:
-                    sym_not_found_warnings_printed.add(sym_name)
-                    # This may happen with static inline definitions.
-                    print(f'Note: referencing symbol {sym_name} ({section.name}) not found in definitions, ignoring')
-                    if args.trace:
-                        print(f'{obj.name} ({obj.archive})')
-                        for section, syms in defs_grouped[obj].items():
-                            print(f' {section.name}')
-                            for sym_ in syms.values():
-                                print(f'   {sym_.name}')
-                continue
-            # .text. is added for local (static) symbols
-            ref_sym = ref.replace('.text.', '')
-            # .L., .rodata., ..-
-            starts_with_dot = ref_sym.startswith('.')
-            if 'R_X86_64_PC32' in line and starts_with_dot:
-                if args.trace:
-                    print('-> ignoring (starts with dot and is R_X86_64_PC32)')
-                continue
-            assert not starts_with_dot
-            try:
-                suffix_idx = ref_sym.index('-0x')
-            except ValueError:
-                if args.trace:
-                    print('-> ignoring (cannot parse referenced symbol name)')
-                continue
-            ref_sym = ref_sym[:suffix_idx]
-            refs[ref_sym].append(SymbolReference(
-                referencing_sym=sym,
-                referenced_sym=ref_sym,
-                src=src))
-            if args.trace:
-                print(f'found reference: {sym_name} -> {ref_sym}')
-        else:
-            if args.trace:
-                print('-> ignoring')
+# Ingestion is done, the walk iterates the definitions of a section far more often than it looks them up.
+# Definitions are ordered by name and sections by their first definition like nm lists them, not in symbol table order.
+syms_by_section: Dict[Section, Tuple[DefinedSymbol, ...]] = {
+    section: tuple(sorted(section_syms.values(), key=lambda sym: sym.name)) for section, section_syms in defs_by_section.items()}
+syms_by_obj: Dict[Object, Tuple[Tuple[Section, Tuple[DefinedSymbol, ...]], ...]] = {
+    obj: tuple((section, syms_by_section[section]) for section in sorted(sections, key=lambda section: syms_by_section[section][0].name))
+    for obj, sections in sections_by_obj.items()}
 
 if args.verbose:
     print('==== symbols and direct references ====')
-    for obj, sections in defs_grouped.items():
+    for obj, obj_syms in syms_by_obj.items():
         print(f'{obj.name} ({fmt_path(obj.archive)})')
-        for section, syms in sections.items():
+        for section, section_syms in obj_syms:
             print(f' {section.name}')
-            for sym in syms.values():
+            for sym in section_syms:
                 print(f'   {sym.name}() @ {fmt_path(sym.src)}')
                 for ref in refs[sym.name]:
                     print(f'    ref by {ref.referencing_sym.name}() @ {fmt_path(ref.src)}')
@@ -379,8 +674,8 @@ class LinkReference(NamedTuple):
 
 LinkReferencePath = Tuple[LinkReference,...]
 
-if args.require_defined:
-    require_defined: Set[SymbolName] = set(args.require_defined)
+# Empty with --whole-archive.
+require_defined: FrozenSet[SymbolName] = frozenset(args.require_defined or ())
 
 def prune_link_ref_path(path: LinkReferencePath) -> LinkReferencePath:
     if len(path) == 0:
@@ -390,112 +685,192 @@ def prune_link_ref_path(path: LinkReferencePath) -> LinkReferencePath:
             return tuple()
         return path
     elif args.require_defined:
-        found_required_at = -1
-        for i, link_ref in enumerate(path[::-1]):
-            if isinstance(link_ref.ref, DefinedSymbol):
-                if args.direct_only:
-                    return tuple()
-                sym_name = link_ref.ref.name
-            else:
-                sym_name = link_ref.ref.referencing_sym.name
-            if found_required_at == -1:
-                if sym_name in require_defined:
-                    found_required_at = len(path) - 1 - i
-                    if not args.direct_only:
-                        break
-        if found_required_at == -1:
+        if args.direct_only and any(isinstance(r.ref, DefinedSymbol) for r in path):
             return tuple()
-        else:
-            return tuple(path[:found_required_at + 1])
-    
+        # Cut after the last required symbol, scanning backwards without copying the path.
+        for i in range(len(path) - 1, -1, -1):
+            ref = path[i].ref
+            sym_name = ref.name if isinstance(ref, DefinedSymbol) else ref.referencing_sym.name
+            if sym_name in require_defined:
+                return path[:i + 1]
+        return tuple()
+
     assert False
 
-def walk_link_ref_paths(sym_name: str, path_fn: Callable[[LinkReferencePath], bool],
-                        head_path: LinkReferencePath=()) -> bool:
-    if args.trace:
-        print(f'ref: {sym_name}')
-    sym_refs = refs[sym_name]
-    if not sym_refs:
-        pruned_path = prune_link_ref_path(head_path)
+# A symbol is typically visited many times during the search, group its references only once.
+@lru_cache(maxsize=None)
+def group_refs(sym_name: SymbolName) -> Tuple[Tuple[Union[Object, Section], FrozenSet[SymbolReference], Dict[DefinedSymbol, SymbolReference]], ...]:
+    # Group references by the section/object they are made from.
+    # Groups are sorted, their order decides the order of found paths.
+    # Each group also maps its referencing symbols to their first reference, for direct references in link paths.
+    sym_refs_by_group: DefaultDict[Union[Object, Section], List[SymbolReference]] = defaultdict(list)
+    for sym_ref in refs[sym_name]:
+        section = sym_ref.referencing_sym.section
+        sym_refs_by_group[section if args.gc_sections else section.obj].append(sym_ref)
+    grouped = []
+    for group, sym_refs_ in sorted(sym_refs_by_group.items()):
+        ref_by_sym: Dict[DefinedSymbol, SymbolReference] = {}
+        for sym_ref in sym_refs_:
+            ref_by_sym.setdefault(sym_ref.referencing_sym, sym_ref)
+        grouped.append((group, frozenset(sym_refs_), ref_by_sym))
+    return tuple(grouped)
+
+def walk_link_ref_paths(sym_name: str, path_fn: Callable[[LinkReferencePath, int], bool]) -> bool:
+    # Iterative depth-first search over the symbols referencing sym_name.
+    # Each stack entry iterates the children of one symbol on the current path,
+    # head_path/head_groups hold the link references/group ids of that path.
+    # Objects and sections are interned (mk_object/mk_section), so ids identify them
+    # and membership tests do not need to hash the tuples.
+    # head_hashes[i] is a rolling hash of head_path[:i + 1], passed on to path_fn.
+    head_path: List[LinkReference] = []
+    head_hashes: List[int] = []
+    head_groups: Set[int] = set()
+
+    def push_link_ref(link_ref: LinkReference):
+        head_path.append(link_ref)
+        head_hashes.append(hash((head_hashes[-1] if head_hashes else 0, link_ref)))
+        head_groups.add(id(link_ref.group))
+
+    def pop_link_ref():
+        link_ref = head_path.pop()
+        head_hashes.pop()
+        head_groups.discard(id(link_ref.group))
+
+    def on_path_end(stopped_at_cycle: bool) -> bool:
+        path = tuple(head_path)
+        pruned_path = prune_link_ref_path(path)
         if pruned_path:
             if args.verbose:
-                print('path found!')
-                if len(head_path) != len(pruned_path):
-                    print(f'original: {head_path}')
+                print('path found! (stopped at cycle start)' if stopped_at_cycle else 'path found!')
+                if len(path) != len(pruned_path):
+                    print(f'original: {path}')
                     print(f'pruned:   {pruned_path}')
-            return path_fn(pruned_path)
+            # Pruning only ever cuts off the tail, so the pruned path is a prefix of head_path.
+            return path_fn(pruned_path, head_hashes[len(pruned_path) - 1])
         return True
-    if args.gc_sections:
-        def by_section_key(sym_ref: SymbolReference):
-            return sym_ref.referencing_sym.section
-        sym_refs = sorted(sym_refs, key=by_section_key) # groupby requires sorted iterable
-        sym_refs_by_section = groupby(sym_refs, key=by_section_key)
-        for section, sym_refs_ in sym_refs_by_section:
-            if args.trace:
-                print(f' {section.name} {section.obj.name}')
-            if section in set(link_ref.group for link_ref in head_path):
-                # TODO stopping at cycles leads to truncated paths which may be confusing
-                if args.trace:
-                    print('cycle detected, stopping here')
-                    link_path = ' -> '.join(link_ref.group.name for link_ref in head_path)
-                    print(link_path)
-                pruned_path = prune_link_ref_path(head_path)
-                if pruned_path:
-                    if args.verbose:
-                        print('path found! (stopped at cycle start)')
-                        if len(head_path) != len(pruned_path):
-                            print(f'original: {head_path}')
-                            print(f'pruned:   {pruned_path}')
-                    return path_fn(pruned_path)
-                return True
-            sym_refs_ = frozenset(sym_refs_)
-            for sym in defs_grouped[section.obj][section].values():
-                if args.trace:
-                    print(f'  {sym.name}')
-                ref = next((r for r in sym_refs_ if r.referencing_sym == sym), sym)
-                link_ref = LinkReference(section, sym_refs_, ref)
-                if not walk_link_ref_paths(sym.name, path_fn, (*head_path, link_ref)):
-                    if args.verbose:
-                        print('stopping search')
-                    return False
-    else:
-        def by_obj_key(sym_ref: SymbolReference):
-            return sym_ref.referencing_sym.section.obj
-        sym_refs = sorted(sym_refs, key=by_obj_key)
-        sym_refs_by_obj = groupby(sym_refs, key=by_obj_key)
-        for obj, sym_refs_ in sym_refs_by_obj:
-            if args.trace:
-                print(f'obj: {obj.name}')
-            if obj in set(link_ref.group for link_ref in head_path):
-                # TODO stopping at cycles leads to truncated paths which may be confusing
-                if args.trace:
-                    print('cycle detected')
-                    if args.trace:
+
+    # Groups already on the current path are skipped, they would close a cycle.
+    # Yields only None if all groups are skipped, the path then ends in a cycle.
+    def children(sym_name: str) -> Iterator[Optional[Tuple[LinkReference, SymbolName]]]:
+        trace = args.trace
+        in_cycle = True
+        if args.gc_sections:
+            for section, sym_refs_, ref_by_sym in group_refs(sym_name):
+                if trace:
+                    print(f' {section.name} {section.obj.name}')
+                if id(section) in head_groups:
+                    if trace:
+                        print('cycle detected, skipping section')
                         link_path = ' -> '.join(link_ref.group.name for link_ref in head_path)
                         print(link_path)
-                pruned_path = prune_link_ref_path(head_path)
-                if pruned_path:
-                    if args.verbose:
-                        print('path found! (stopped at cycle start)')
-                        if len(head_path) != len(pruned_path):
-                            print(f'original: {head_path}')
-                            print(f'pruned:   {pruned_path}')
-                    return path_fn(pruned_path)
-                return True
-            sym_refs_ = frozenset(sym_refs_)
-            for section, section_syms in defs_grouped[obj].items():
-                if args.trace:
-                    print(f'section: {section.name}')
-                for sym in section_syms.values():
-                    if args.trace:
-                        print(f'{obj.name} {section.name} {sym.name}')
-                    ref = next((r for r in sym_refs_ if r.referencing_sym == sym), sym)
-                    link_ref = LinkReference(obj, sym_refs_, ref)
-                    if not walk_link_ref_paths(sym.name, path_fn, (*head_path, link_ref)):
-                        if args.verbose:
-                            print('stopping search')
-                        return False
-    return True
+                    continue
+                in_cycle = False
+                for sym in syms_by_section[section]:
+                    if trace:
+                        print(f'  {sym.name}')
+                    ref = ref_by_sym.get(sym, sym)
+                    yield LinkReference(section, sym_refs_, ref), sym.name
+        else:
+            for obj, sym_refs_, ref_by_sym in group_refs(sym_name):
+                if trace:
+                    print(f'obj: {obj.name}')
+                if id(obj) in head_groups:
+                    if trace:
+                        print('cycle detected, skipping object')
+                        link_path = ' -> '.join(link_ref.group.name for link_ref in head_path)
+                        print(link_path)
+                    continue
+                in_cycle = False
+                for section, syms in syms_by_obj[obj]:
+                    if trace:
+                        print(f'section: {section.name}')
+                    for sym in syms:
+                        if trace:
+                            print(f'{obj.name} {section.name} {sym.name}')
+                        ref = ref_by_sym.get(sym, sym)
+                        yield LinkReference(obj, sym_refs_, ref), sym.name
+        if in_cycle:
+            # TODO stopping at cycles leads to truncated paths which may be confusing
+            if trace:
+                print('cycle detected, stopping here')
+            yield None
+
+    if args.trace:
+        print(f'ref: {sym_name}')
+    if not refs[sym_name]:
+        return on_path_end(stopped_at_cycle=False)
+    stack = [children(sym_name)]
+    exhausted = object()
+    while stack:
+        child = next(stack[-1], exhausted)
+        if child is exhausted:
+            stack.pop()
+            if stack:
+                pop_link_ref()
+            continue
+        if child is None:
+            if not on_path_end(stopped_at_cycle=True):
+                break
+            continue
+        link_ref, child_name = child
+        push_link_ref(link_ref)
+        if args.trace:
+            print(f'ref: {child_name}')
+        if refs[child_name]:
+            stack.append(children(child_name))
+            continue
+        keep_going = on_path_end(stopped_at_cycle=False)
+        pop_link_ref()
+        if not keep_going:
+            break
+    else:
+        return True
+    if args.verbose:
+        print('stopping search')
+    return False
+
+def find_shortest_link_ref_path(sym_name: str) -> LinkReferencePath:
+    # Breadth-first search for --first-only, each symbol is expanded at most once.
+    # All symbols of a group are reached in the same step, so a shortest path never
+    # enters a group twice and needs no cycle check.
+    # Ends at the nearest required symbol, or with --whole-archive at the nearest unreferenced one.
+    # Returns an empty path if there is none, e.g. if all paths end in cycles.
+    parents: Dict[SymbolName, Optional[Tuple[LinkReference, SymbolName]]] = {sym_name: None}
+    queue = deque([sym_name])
+    while queue:
+        name = queue.popleft()
+        for group, sym_refs_, ref_by_sym in group_refs(name):
+            if isinstance(group, Section):
+                group_syms = ((group, syms_by_section[group]),)
+            else:
+                group_syms = syms_by_obj[group]
+            for _, syms in group_syms:
+                for sym in syms:
+                    if sym.name in parents:
+                        continue
+                    ref = ref_by_sym.get(sym, sym)
+                    parents[sym.name] = (LinkReference(group, sym_refs_, ref), name)
+                    if args.whole_archive:
+                        is_root = not refs[sym.name]
+                    else:
+                        is_root = sym.name in require_defined
+                    if is_root:
+                        path: List[LinkReference] = []
+                        parent = parents[sym.name]
+                        while parent is not None:
+                            link_ref, parent_name = parent
+                            path.append(link_ref)
+                            parent = parents[parent_name]
+                        path.reverse()
+                        return tuple(path)
+                    queue.append(sym.name)
+    return tuple()
+
+def get_prefix(sym: DefinedSymbol) -> str:
+    if sym.is_global and sym.name in require_defined:
+        return '!'
+    else:
+        return ' '
 
 def print_link_ref_path(path: LinkReferencePath):
     for i, link_ref in enumerate(path):
@@ -503,12 +878,6 @@ def print_link_ref_path(path: LinkReferencePath):
             print(f'#{len(path)-i-1}  {link_ref.group.name} ({fmt_path(link_ref.group.archive)})')
         else: # Section
             print(f'#{len(path)-i-1}  {link_ref.group.name} ({link_ref.group.obj.name} {fmt_path(link_ref.group.obj.archive)})')
-        
-        def get_prefix(sym: DefinedSymbol):
-            if sym.is_global and args.require_defined and sym.name in require_defined:
-                return '!'
-            else:
-                return ' '
 
         if isinstance(link_ref.ref, SymbolReference):
             # Direct reference, print only that.
@@ -537,22 +906,29 @@ for sym_name in args.trace_symbol:
     else:
         loc = '(multiple defs)'
         src = ''
-    seen = set()
-    def on_path_found(path: LinkReferencePath):
+    # Paths by their rolling hash, compared in full only on a hash match.
+    seen: Dict[int, List[LinkReferencePath]] = {}
+    def on_path_found(path: LinkReferencePath, path_hash: int):
         # Pruning can produce duplicate paths, only print once.
-        if path in seen:
+        same_hash = seen.setdefault(path_hash, [])
+        if path in same_hash:
             return True
-        seen.add(path)
+        same_hash.append(path)
         global found
         found = True
         print(f'#{len(path)}  {loc}')
         print(f'  *   {sym_name} {fmt_path(src)}')
         print_link_ref_path(path)
-        print()
+        print(flush=True)
         if args.first_only:
             return False # stop
         return True # keep going
-    walk_link_ref_paths(sym_name, on_path_found)
+    # --direct-only needs the pruning of the depth-first search.
+    shortest_path = find_shortest_link_ref_path(sym_name) if args.first_only and not args.direct_only else None
+    if shortest_path:
+        on_path_found(shortest_path, hash(shortest_path))
+    else:
+        walk_link_ref_paths(sym_name, on_path_found)
     if not seen:
         print(f'No paths found for {sym_name}.')
         print()
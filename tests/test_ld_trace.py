@@ -0,0 +1,86 @@
+# End-to-end tests, objects are compiled on the fly and ld-trace.py is run as a script.
+
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ld-trace.py')
+
+pytestmark = pytest.mark.skipif(not (shutil.which('gcc') and shutil.which('objdump') and shutil.which('ar')),
+                                reason='requires gcc, ar and objdump')
+
+def compile_c(tmp_path, name: str, code: str, *flags: str) -> str:
+    src = tmp_path / f'{name}.c'
+    src.write_text(code)
+    subprocess.run(['gcc', '-c', '-g', *flags, '-o', f'{name}.o', src.name], cwd=tmp_path, check=True)
+    return f'{name}.o'
+
+def ld_trace(tmp_path, *args: str) -> str:
+    result = subprocess.run([sys.executable, SCRIPT, '--cache-dir', str(tmp_path / 'cache'), *args],
+                            cwd=tmp_path, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    assert result.returncode == 0, result.stdout
+    return result.stdout
+
+def test_function_in_custom_section(tmp_path):
+    func_o = compile_c(tmp_path, 'func', 'void func(void) {}\n')
+    sec_o = compile_c(tmp_path, 'sec',
+        'void func(void);\n'
+        '__attribute__((section("mysec"))) void custom(void) { func(); }\n'
+        'void _start(void) { custom(); }\n')
+    out = ld_trace(tmp_path, '-y', 'func', sec_o, func_o)
+    assert 'not found in definitions' not in out
+    assert '#0  sec.o (sec.o)' in out
+    assert ' ^    custom ' in out
+
+def test_first_only_agrees_with_full_search(tmp_path):
+    # b's first section .text.A is already on the path when coming from A, only .text._start leads on.
+    obj = compile_c(tmp_path, 'cyc',
+        'void f(void) {}\n'
+        'void b(void);\n'
+        'void A(void) { f(); b(); }\n'
+        'void b(void) { A(); }\n'
+        'void _start(void) { b(); }\n',
+        '-ffunction-sections')
+    full = ld_trace(tmp_path, '-y', 'f', '--gc-sections', obj)
+    first = ld_trace(tmp_path, '-y', 'f', '--gc-sections', '--first-only', obj)
+    assert 'No paths found' not in full
+    assert 'No paths found' not in first
+    first_path = first.strip().split('\n\n')[-1]
+    assert '!^*   _start ' in first_path
+    assert first_path in full
+
+def test_prefilter_keeps_static_traced_symbol(tmp_path):
+    s_o = compile_c(tmp_path, 's', 'static void lhelper(void) {}\nvoid sfunc(void) { lhelper(); }\n', '-ffunction-sections')
+    z_o = compile_c(tmp_path, 'z', 'void zfunc(void) {}\n')
+    subprocess.run(['ar', 'rcs', 'libs.a', s_o], cwd=tmp_path, check=True)
+    subprocess.run(['ar', 'rcs', 'libz.a', z_o], cwd=tmp_path, check=True)
+    m_o = compile_c(tmp_path, 'm', 'void sfunc(void);\nvoid _start(void) { sfunc(); }\n')
+    out = ld_trace(tmp_path, '-y', 'lhelper', '--prefilter', '--verbose', m_o, 'libs.a', 'libz.a')
+    assert 'NOTE: skipping libz.a' in out
+    assert 'NOTE: skipping libs.a' not in out
+    assert 'No paths found' not in out
+    assert '#1  s.o (libs.a)' in out
+
+def test_library_search_skips_dangling_symlink(tmp_path):
+    (tmp_path / 'L1').mkdir()
+    (tmp_path / 'L2').mkdir()
+    os.symlink('missing.a', tmp_path / 'L1' / 'libfoo.a')
+    func_o = compile_c(tmp_path, 'func', 'void func(void) {}\n')
+    subprocess.run(['ar', 'rcs', 'L2/libfoo.a', func_o], cwd=tmp_path, check=True)
+    main_o = compile_c(tmp_path, 'main', 'void func(void);\nvoid _start(void) { func(); }\n')
+    out = ld_trace(tmp_path, '-y', 'func', '-L', 'L1', '-L', 'L2', '-lfoo', main_o)
+    assert '#1  func.o (libfoo.a)' in out
+
+def test_cache_files_are_not_private(tmp_path):
+    func_o = compile_c(tmp_path, 'func', 'void func(void) {}\n')
+    os.utime(tmp_path / func_o, (0, 0)) # old enough for its content hash to be stored
+    ld_trace(tmp_path, '-y', 'func', '--whole-archive', func_o)
+    umask = os.umask(0)
+    os.umask(umask)
+    cache_files = list((tmp_path / 'cache').iterdir())
+    assert len(cache_files) == 2 # output and .meta
+    for path in cache_files:
+        assert path.stat().st_mode & 0o777 == 0o666 & ~umask